@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, redirect, make_response
+from flask import Flask, Response, request, jsonify, redirect, make_response, send_file
 from flask_cors import CORS
 import jwt
 import datetime
@@ -7,13 +7,19 @@ import os
 import json
 import requests
 from dotenv import load_dotenv
-from auth import token_requerido  
+from auth import token_requerido, token_requerido_ou_query
+import custos
+from idempotencia import idempotente
+import perfil
+import eventos
+import sincml
+import imagens
 
 
 load_dotenv('mysql.env')
 
 app = Flask(__name__)
-CORS(app, supports_credentials=True, origins=["http://localhost:5173"])
+CORS(app, supports_credentials=True, origins=["http://localhost:5173"], expose_headers=["X-Proximo-Cursor"])
 app.config['SECRET_KEY'] = '8bf9485269a4ba37e6c37f918bf073932488be7a05a1bc3504aee4627b48aed1'
 
 # ----- Configurações da API do Mercado Livre -----
@@ -23,7 +29,7 @@ REDIRECT_URI = 'https://erp-backend-9ggy.onrender.com/auth/callback'
 
 # Função de conexão ao banco
 def conectar():
-    return pymysql.connect(
+    return perfil.ConexaoPerfilada(
         host=os.getenv('DB_HOST'),
         user=os.getenv('DB_USER'),
         password=os.getenv('DB_PASSWORD'),
@@ -32,14 +38,26 @@ def conectar():
         cursorclass=pymysql.cursors.DictCursor
     )
 
+perfil.registrar(app, conectar)
+sinc_ml = sincml.SincronizadorEstoque(conectar, client_id=CLIENT_ID, client_secret=CLIENT_SECRET)
+
 # ---------- INICIAR AUTENTICAÇÃO COM MERCADO LIVRE ----------
+# O navegador abre esta rota direto (token em ?token=). O usuário vai no
+# state assinado, para o callback saber de quem é a conta do ML.
 @app.route('/auth/login')
+@token_requerido_ou_query
 def auth_login():
+    state = jwt.encode({
+        'id': request.usuario['id'],
+        'finalidade': 'ml_auth',
+        'exp': datetime.datetime.utcnow() + datetime.timedelta(minutes=10)
+    }, app.config['SECRET_KEY'], algorithm='HS256')
     auth_url = (
         f'https://auth.mercadolivre.com.br/authorization'
         f'?response_type=code'
         f'&client_id={CLIENT_ID}'
         f'&redirect_uri={REDIRECT_URI}'
+        f'&state={state}'
     )
     return redirect(auth_url)
 
@@ -49,6 +67,12 @@ def auth_callback():
     code = request.args.get('code')
     if not code:
         return jsonify({'erro': 'Código não fornecido'}), 400
+    try:
+        state = jwt.decode(request.args.get('state', ''), app.config['SECRET_KEY'], algorithms=['HS256'])
+    except jwt.InvalidTokenError:
+        return jsonify({'erro': 'state inválido ou expirado'}), 400
+    if state.get('finalidade') != 'ml_auth':
+        return jsonify({'erro': 'state inválido ou expirado'}), 400
 
     token_url = 'https://api.mercadolibre.com/oauth/token'
     payload = {
@@ -67,8 +91,17 @@ def auth_callback():
     access_token = tokens.get('access_token')
     refresh_token = tokens.get('refresh_token')
 
-    # Aqui você pode salvar no banco se quiser associar ao usuário
-    print("Token recebido:", tokens)
+    # usado pela sincronização de estoque (sincml), que renova quando expira
+    con = conectar()
+    with con:
+        with con.cursor() as cur:
+            cur.execute("""
+                INSERT INTO TokenML (user_id, access_token, refresh_token, expira_em)
+                VALUES (%s, %s, %s, NOW() + INTERVAL %s SECOND)
+                ON DUPLICATE KEY UPDATE access_token = VALUES(access_token),
+                    refresh_token = VALUES(refresh_token), expira_em = VALUES(expira_em)
+            """, (state['id'], access_token, refresh_token, int(tokens.get('expires_in', 21600))))
+        con.commit()
 
     return jsonify({
         'mensagem': 'Autenticação concluída com sucesso!',
@@ -86,9 +119,16 @@ def webhook_mercado_livre():
     print("Webhook recebido:", payload)
 
     # Aqui futuramente salvaremos na tabela NotificacoesML
+    # e avisaremos as telas abertas com eventos.publicar(user_id, 'pedido', {...})
     return jsonify({'mensagem': 'OK'}), 200
 
 
+#---------- STATUS DA SINCRONIZAÇÃO DE ESTOQUE COM O ML (deste worker) ----------
+@app.route('/integracoes/mercadolivre/sincronizacao', methods=['GET'])
+@token_requerido
+def status_sincronizacao_ml():
+    return jsonify(sinc_ml.metricas()), 200
+
 
 @app.route('/register', methods=['POST'])
 def cadastrar_usuario():
@@ -265,6 +305,8 @@ def dashboard():
                 WHERE p.user_id = %s
             """, (user_id,))
             dados = cursor.fetchall()
+    for prod in dados:
+        prod['imagem_thumb'] = imagens.miniatura_url(prod['imagem_url'])
     return jsonify(dados), 200
 
 
@@ -299,6 +341,7 @@ def criar_produto():
 
         conn.commit()
 
+    imagens.agendar(imagem_url)
     return jsonify({'mensagem': 'Produto criado com sucesso!', 'cod': novo_cod}), 201
 
 @app.route('/produto/<int:cod>', methods=['GET']) #-- Pega um produto especifico 
@@ -318,6 +361,7 @@ def obter_produto(cod):
             """, (cod, user_id))
             prod = cur.fetchone()
     if prod:
+        prod['imagem_thumb'] = imagens.miniatura_url(prod['imagem_url'])
         return jsonify(prod), 200
     return jsonify({'mensagem':'Produto não encontrado'}), 404
 
@@ -350,8 +394,30 @@ def atualizar_produto(cod):
             """, (dados['quantity'], cod))
 
         conn.commit()
+
+    eventos.publicar(user_id, 'estoque', {'cod': cod, 'quantidade': dados['quantity']})
+    sinc_ml.registrar(cod)
+    imagens.agendar(dados['image_url'])
     return jsonify({'mensagem':'Produto atualizado com sucesso!'}), 200
 
+#---------- MINIATURAS DOS PRODUTOS (cache local) ----------
+# Sem token: o <img> do navegador não manda Authorization e o nome é o sha256
+# do conteúdo. Como o conteúdo de um nome nunca muda, o cache pode ser eterno.
+@app.route('/imagens/<nome>', methods=['GET'])
+def servir_imagem(nome):
+    if not imagens.NOME_VALIDO.match(nome):
+        return jsonify({'mensagem': 'Imagem não encontrada'}), 404
+    sha = nome[:-4]
+    caminho = imagens.miniatura(sha)
+    if not os.path.exists(caminho):
+        return jsonify({'mensagem': 'Imagem não encontrada'}), 404
+
+    imagens.tocar(caminho)
+    resposta = send_file(caminho, mimetype='image/jpeg', etag=sha, max_age=365*24*60*60)
+    resposta.cache_control.public = True
+    resposta.cache_control.immutable = True
+    return resposta
+
 
 # ------------------------------------------------------------------------
 
@@ -375,6 +441,7 @@ def listar_financas():
 
 @app.route('/finance', methods=['POST']) # ---- CRIAR nova transação 
 @token_requerido
+@idempotente
 def criar_financa():
     dados = request.get_json()
     conn = conectar()
@@ -489,6 +556,7 @@ def listar_compras():
 
 @app.route('/comprasdashboard', methods=['POST'])
 @token_requerido
+@idempotente
 def criar_compra():
     d   = request.get_json()
     uid = request.usuario['id']
@@ -519,6 +587,7 @@ def criar_compra():
                 nova_quantidade = estoque['quantidade'] + d['quantidade']
                 cur.execute("UPDATE Estoque SET quantidade = %s WHERE fk_cod_prod = %s", (nova_quantidade, produto_id))
             else:
+                nova_quantidade = d['quantidade']
                 cur.execute("""
                 INSERT INTO Estoque (fk_cod_prod, data, quantidade)
                 VALUES (%s, %s, %s)
@@ -526,6 +595,9 @@ def criar_compra():
 
         con.commit()
 
+    eventos.publicar(uid, 'estoque', {'cod': produto_id, 'quantidade': nova_quantidade})
+    sinc_ml.registrar(produto_id)
+
     return jsonify({'mensagem': 'Compra criada e estoque atualizado!'}), 201
 
 
@@ -593,14 +665,38 @@ def listar_vendas():
             """, (uid,))
             vendas = cur.fetchall()
     return jsonify(vendas), 200
+
+# helper: mantém PedidoAbertoContagem (badges da tela de pedidos). Chamar na
+# mesma transação que insere/altera/remove o pedido; finalizados não contam.
+def contar_pedido_aberto(cur, user_id, status, canal, delta):
+    # mesma regra da coluna Pedido.aberto: COALESCE(status, '') <> 'finalizado'
+    status = status or ''
+    if status.lower() == 'finalizado':
+        return
+    cur.execute("""
+        INSERT INTO PedidoAbertoContagem (user_id, status, canal, total)
+        VALUES (%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE total = total + VALUES(total)
+    """, (user_id, status, canal or '', delta))
+
 #---------------EDITAR as Vendas------------------
 @app.route('/vendas/<int:id>', methods=['PUT'])
 @token_requerido
 def atualizar_venda(id):
     d = request.get_json()
+    uid = request.usuario['id']
     con = conectar()
     with con:
         with con.cursor() as cur:
+            # estado anterior, para acertar os contadores de pedidos abertos
+            cur.execute("""
+                SELECT status, fk_marketplace_id FROM Pedido
+                WHERE id = %s AND user_id = %s FOR UPDATE
+            """, (id, uid))
+            anterior = cur.fetchone()
+            if not anterior:
+                return jsonify({'mensagem': 'Venda não encontrada'}), 404
+
             cur.execute("SELECT COD FROM Produto WHERE nome = %s", (d['produto_nome'],))
             prod = cur.fetchone()
             if not prod:
@@ -619,6 +715,8 @@ def atualizar_venda(id):
                 d['status'],
                 id
             ))
+            contar_pedido_aberto(cur, uid, anterior['status'], anterior['fk_marketplace_id'], -1)
+            contar_pedido_aberto(cur, uid, d['status'], anterior['fk_marketplace_id'], 1)
 
             cur.execute("SELECT id_cliente FROM Pedido WHERE id = %s", (id,))
             pedido = cur.fetchone()
@@ -634,6 +732,11 @@ def atualizar_venda(id):
                 ))
 
         con.commit()
+
+    eventos.publicar(uid, 'pedido', {
+        'acao': 'atualizado', 'id': id, 'produto': d['produto_nome'], 'cliente': d['cliente_nome'],
+        'quantidade': d['quantidade'], 'preco': d['preco'], 'status': d['status'], 'data': d['data']
+    })
     return jsonify({'mensagem': 'Venda atualizada com sucesso'}), 200
 
 
@@ -646,16 +749,29 @@ def remover_venda(id):
     con = conectar()
     with con:
         with con.cursor() as cur:
+            cur.execute("""
+                SELECT status, fk_marketplace_id FROM Pedido
+                WHERE id = %s AND user_id = %s FOR UPDATE
+            """, (id, uid))
+            pedido = cur.fetchone()
+            if not pedido:
+                return jsonify({'mensagem': 'Venda não encontrada'}), 404
+
             cur.execute("DELETE FROM Pedido WHERE id=%s", (id,))
+            contar_pedido_aberto(cur, uid, pedido['status'], pedido['fk_marketplace_id'], -1)
         con.commit()
+
+    eventos.publicar(uid, 'pedido', {'acao': 'removido', 'id': id})
     return jsonify({'mensagem': 'Venda removida com sucesso'}), 200
 
 
 #---------------CRIAR Venda------------------------------
 @app.route('/vendas', methods=['POST'])
 @token_requerido
+@idempotente
 def criar_venda():
     d = request.get_json()
+    uid = request.usuario['id']
     con = conectar()
     try:
         with con:
@@ -684,8 +800,8 @@ def criar_venda():
 
                 # 4. Inserir o pedido
                 cur.execute("""
-                    INSERT INTO Pedido (data, quantidade, valor_final, status, id_produto, id_cliente, fk_marketplace_id)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                    INSERT INTO Pedido (data, quantidade, valor_final, status, id_produto, id_cliente, fk_marketplace_id, user_id)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
                 """, (
                     d['data'],
                     d['quantidade'],
@@ -693,8 +809,11 @@ def criar_venda():
                     d['status'],
                     produto_id,
                     cliente_id,
-                    'avulso'
+                    'avulso',
+                    uid
                 ))
+                pedido_id = cur.lastrowid
+                contar_pedido_aberto(cur, uid, d['status'], 'avulso', 1)
 
                 # 5. Se o status for finalizado, descontar do estoque
                 if d['status'].lower() == 'finalizado':
@@ -704,6 +823,15 @@ def criar_venda():
                     """, (nova_qtd, produto_id))
 
             con.commit()
+
+        eventos.publicar(uid, 'pedido', {
+            'acao': 'criado', 'id': pedido_id, 'produto': d['produto_nome'], 'cliente': d['cliente_nome'],
+            'quantidade': d['quantidade'], 'preco': d['valor_final'], 'status': d['status'],
+            'data': d['data'], 'canal': 'avulso'
+        })
+        if d['status'].lower() == 'finalizado':
+            eventos.publicar(uid, 'estoque', {'cod': produto_id, 'quantidade': nova_qtd})
+            sinc_ml.registrar(produto_id)
         return jsonify({'mensagem': 'Venda criada com sucesso'}), 201
 
     except Exception as e:
@@ -739,6 +867,36 @@ def relatorio_lucro_mensal():
             dados = cur.fetchall()
     return jsonify(dados), 200
 
+#-------------- MARGEM BRUTA (CMV por PEPS ou custo médio) --------------
+@app.route('/relatorios/margem-produto', methods=['GET'])
+@token_requerido
+def relatorio_margem_produto():
+    uid = request.usuario['id']
+    metodo = request.args.get('metodo', 'fifo')
+    if metodo not in custos.METODOS:
+        return jsonify({'erro': 'Método inválido (use fifo ou media)'}), 400
+
+    con = conectar()
+    with con:
+        mov = custos.carregar_movimentos(con, uid)
+        with con.cursor() as cur:
+            cur.execute("SELECT COD, nome FROM Produto WHERE user_id = %s", (uid,))
+            nomes = {row['COD']: row['nome'] for row in cur.fetchall()}
+    return jsonify(custos.margem_por_produto(mov, metodo, nomes)), 200
+
+@app.route('/relatorios/margem-mensal', methods=['GET'])
+@token_requerido
+def relatorio_margem_mensal():
+    uid = request.usuario['id']
+    metodo = request.args.get('metodo', 'fifo')
+    if metodo not in custos.METODOS:
+        return jsonify({'erro': 'Método inválido (use fifo ou media)'}), 400
+
+    con = conectar()
+    with con:
+        mov = custos.carregar_movimentos(con, uid)
+    return jsonify(custos.margem_por_mes(mov, metodo)), 200
+
 @app.route('/produtos', methods=['GET'])
 @token_requerido
 def listar_produtos():
@@ -751,25 +909,36 @@ def listar_produtos():
     return jsonify(produtos), 200
 
 #---------- PEDIDOS  --------------
+# Só pedidos em aberto, pelo índice (user_id, aberto, data, id). Paginação por
+# chave: a próxima página vem do header X-Proximo-Cursor, passado de volta
+# em ?cursor=.
 @app.route('/pedidos', methods=['GET'])
 @token_requerido
 def listar_pedidos():
     uid = request.usuario['id']
     status = request.args.get('status')  # ex: 'a_enviar', 'concluido', etc
     canal = request.args.get('canal')    # ex: 'Mercado Livre', 'Shopee', etc
+    cursor = request.args.get('cursor')
+    # paginação só quando pedida (limite ou cursor); sem eles, a lista completa
+    limite = None
+    if 'limite' in request.args or cursor:
+        try:
+            limite = max(1, min(int(request.args.get('limite', 100)), 500))
+        except ValueError:
+            return jsonify({'erro': 'limite inválido'}), 400
 
     con = conectar()
     with con:
         with con.cursor() as cur:
             query = """
                 SELECT  p.id, c.nome AS cliente, pr.nome AS produto,
-                        p.quantidade, p.status, m.nome AS canal
+                        p.quantidade, p.status, m.nome AS canal, p.data
                         FROM Pedido p
                         JOIN Cliente c ON c.id = p.id_cliente
                         JOIN Produto pr ON pr.COD = p.id_produto
                         LEFT JOIN Marketplace m ON p.fk_marketplace_id = m.id
-                        WHERE pr.user_id = %s
-                        AND p.status != "finalizado"
+                        WHERE p.user_id = %s
+                        AND p.aberto = 1
                 """
             params = [uid]
 
@@ -779,14 +948,77 @@ def listar_pedidos():
             if canal:
                 query += " AND m.nome = %s"
                 params.append(canal)
+            # No DESC do MySQL os pedidos sem data vêm por último; no cursor
+            # eles aparecem com a data vazia ("|id").
+            if cursor:
+                data, sep, ultimo_id = cursor.rpartition('|')
+                if not sep or not ultimo_id.isdigit():
+                    return jsonify({'erro': 'cursor inválido'}), 400
+                if data:
+                    query += " AND (p.data < %s OR (p.data = %s AND p.id < %s) OR p.data IS NULL)"
+                    params += [data, data, int(ultimo_id)]
+                else:
+                    query += " AND p.data IS NULL AND p.id < %s"
+                    params.append(int(ultimo_id))
 
-            query += " ORDER BY p.data DESC"
+            query += " ORDER BY p.data DESC, p.id DESC"
+            if limite is not None:
+                query += " LIMIT %s"
+                params.append(limite + 1)
 
             cur.execute(query, tuple(params))
             pedidos = cur.fetchall()
 
-    return jsonify(pedidos), 200
+    resposta = make_response(jsonify([
+        {k: v for k, v in p.items() if k != 'data'} for p in pedidos[:limite]
+    ]), 200)
+    if limite is not None and len(pedidos) > limite:
+        ultimo = pedidos[limite - 1]
+        data = ultimo['data'] if ultimo['data'] is not None else ''
+        resposta.headers['X-Proximo-Cursor'] = f"{data}|{ultimo['id']}"
+    return resposta
+
+#---------- CONTADORES DE PEDIDOS ABERTOS (badges) --------------
+@app.route('/pedidos/contagem', methods=['GET'])
+@token_requerido
+def contagem_pedidos():
+    uid = request.usuario['id']
+    con = conectar()
+    with con:
+        with con.cursor() as cur:
+            cur.execute("""
+                SELECT pc.status, COALESCE(m.nome, pc.canal) AS canal, pc.total
+                FROM PedidoAbertoContagem pc
+                LEFT JOIN Marketplace m ON m.id = pc.canal
+                WHERE pc.user_id = %s AND pc.total > 0
+            """, (uid,))
+            contagem = cur.fetchall()
+    return jsonify(contagem), 200
+
+#---------- FEED DE ALTERAÇÕES (SSE) --------------
+# Substitui o polling de /pedidos e /vendas: eventos 'pedido' e 'estoque' do
+# usuário. Reconectando com Last-Event-ID o cliente recebe o que perdeu; se
+# vier 'reset', o histórico expirou (ou o log foi recriado) e a tela deve
+# recarregar a lista.
+# Com EventSource o token vai em ?token= (o navegador não manda headers).
+# Cada worker aceita até eventos.MAX_CONEXOES streams; acima disso, 503.
+@app.route('/eventos', methods=['GET'])
+@token_requerido_ou_query
+def feed_eventos():
+    uid = request.usuario['id']
+    ultimo = request.headers.get('Last-Event-ID') or request.args.get('ultimo_id')
+
+    if not eventos.reservar():
+        resposta = jsonify({'erro': 'Muitas conexões abertas, tente novamente'})
+        resposta.headers['Retry-After'] = '5'
+        return resposta, 503
 
+    resposta = Response(eventos.assinar(uid, ultimo), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    resposta.call_on_close(eventos.liberar)
+    return resposta
 
 
 if __name__ == '__main__':
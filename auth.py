@@ -8,22 +8,39 @@ SECRET_KEY = '8bf9485269a4ba37e6c37f918bf073932488be7a05a1bc3504aee4627b48aed1'
 def token_requerido(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = None
+        return _verificar_token(_token_do_header(), f, *args, **kwargs)
+    return decorated
+
+# Igual ao token_requerido, mas aceita também ?token= na URL: o EventSource
+# do navegador não consegue mandar o header Authorization. Usar só em rotas
+# que o navegador abre direto, como stream e redirecionamento (o token
+# aparece nos logs de acesso).
+def token_requerido_ou_query(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        token = _token_do_header() or request.args.get('token')
+        return _verificar_token(token, f, *args, **kwargs)
+    return decorated
 
-        if 'Authorization' in request.headers:
-            bearer = request.headers['Authorization']
-            token = bearer.split(" ")[1] if " " in bearer else bearer
+def _token_do_header():
+    token = None
 
-        if not token:
-            return jsonify({'mensagem': 'Token ausente!'}), 401
+    if 'Authorization' in request.headers:
+        bearer = request.headers['Authorization']
+        token = bearer.split(" ")[1] if " " in bearer else bearer
 
-        try:
-            dados = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
-            request.usuario = dados  # salva os dados do token no request
-        except jwt.ExpiredSignatureError:
-            return jsonify({'mensagem': 'Token expirado!'}), 401
-        except jwt.InvalidTokenError:
-            return jsonify({'mensagem': 'Token inválido!'}), 401
+    return token
 
-        return f(*args, **kwargs)
-    return decorated
+def _verificar_token(token, f, *args, **kwargs):
+    if not token:
+        return jsonify({'mensagem': 'Token ausente!'}), 401
+
+    try:
+        dados = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+        request.usuario = dados  # salva os dados do token no request
+    except jwt.ExpiredSignatureError:
+        return jsonify({'mensagem': 'Token expirado!'}), 401
+    except jwt.InvalidTokenError:
+        return jsonify({'mensagem': 'Token inválido!'}), 401
+
+    return f(*args, **kwargs)
@@ -0,0 +1,190 @@
+import numpy as np
+import pymysql
+
+METODOS = ('fifo', 'media')
+
+
+# ---------- CARGA DOS MOVIMENTOS ----------
+# Usa cursor de tuplas (e não DictCursor) para não montar um dict por linha
+# quando o usuário tem milhões de movimentos. Linhas sem preço ou valor ficam
+# de fora: viraria NaN e o JSON da resposta ficaria inválido.
+def carregar_movimentos(con, user_id):
+    with con.cursor(pymysql.cursors.Cursor) as cur:
+        cur.execute("""
+            SELECT produto_id, quantidade, preco_unit, TO_DAYS(data)
+            FROM Compras
+            WHERE user_id = %s AND data IS NOT NULL AND quantidade > 0
+              AND preco_unit IS NOT NULL
+            ORDER BY id
+        """, (user_id,))
+        compras = np.array(cur.fetchall(), dtype=np.float64).reshape(-1, 4)
+
+        cur.execute("""
+            SELECT p.id_produto, p.quantidade, p.valor_final,
+                   TO_DAYS(p.data), EXTRACT(YEAR_MONTH FROM p.data)
+            FROM Pedido p
+            JOIN Produto pr ON pr.COD = p.id_produto
+            WHERE p.status = 'finalizado' AND pr.user_id = %s
+              AND p.data IS NOT NULL AND p.quantidade > 0
+              AND p.valor_final IS NOT NULL
+            ORDER BY p.id
+        """, (user_id,))
+        vendas = np.array(cur.fetchall(), dtype=np.float64).reshape(-1, 5)
+
+    return {
+        'compra_prod':  compras[:, 0].astype(np.int64),
+        'compra_qtd':   compras[:, 1],
+        'compra_preco': compras[:, 2],
+        'compra_dia':   compras[:, 3].astype(np.int64),
+        'venda_prod':   vendas[:, 0].astype(np.int64),
+        'venda_qtd':    vendas[:, 1],
+        'venda_valor':  vendas[:, 2],
+        'venda_dia':    vendas[:, 3].astype(np.int64),
+        'venda_mes':    vendas[:, 4].astype(np.int64),
+    }
+
+
+# helper: ordena compras e vendas por (produto, dia) e monta as somas acumuladas
+# das compras. Os produtos viram índices densos 0..n-1 para usar bincount.
+# Também devolve, para cada venda (na ordem de entrada), o intervalo
+# [ini, ate) das compras do mesmo produto feitas até a data da venda.
+def _preparar(compra_prod, compra_qtd, compra_preco, compra_dia, venda_prod, venda_dia):
+    produtos, inv = np.unique(np.concatenate([compra_prod, venda_prod]), return_inverse=True)
+    pc = inv[:len(compra_prod)]
+    pv = inv[len(compra_prod):]
+    n = len(produtos)
+
+    # lexsort é estável: empates de data mantêm a ordem de chegada (id)
+    oc = np.lexsort((compra_dia, pc))
+    ov = np.lexsort((venda_dia, pv))
+
+    qtd = compra_qtd[oc]
+    # xp/fp: quantidade e custo acumulados de todas as compras, produto após produto
+    xp = np.concatenate([[0.0], np.cumsum(qtd)])
+    fp = np.concatenate([[0.0], np.cumsum(qtd * compra_preco[oc])])
+
+    dmin = min(compra_dia.min(initial=0), venda_dia.min(initial=0))
+    faixa = max(compra_dia.max(initial=0), venda_dia.max(initial=0)) - dmin + 1
+    chave_c = pc[oc] * faixa + (compra_dia[oc] - dmin)
+    chave_v = pv * faixa + (venda_dia - dmin)
+    primeira = np.searchsorted(chave_c, np.arange(n) * faixa, side='left')
+    ini = primeira[pv]
+    ate = np.searchsorted(chave_c, chave_v, side='right')
+    return pv, n, ov, xp, fp, ini, ate
+
+
+# helper: mínimo acumulado reiniciando a cada grupo (grupo em ordem crescente).
+# Trabalha sobre os postos dos valores, que são inteiros, para o deslocamento
+# por grupo ser exato.
+def _minimo_acumulado(valores, grupo):
+    m = len(valores)
+    ordem = np.argsort(valores, kind='stable')
+    posto = np.empty(m, dtype=np.int64)
+    posto[ordem] = np.arange(m)
+    deslocado = posto - grupo.astype(np.int64) * m
+    return valores[ordem[np.minimum.accumulate(deslocado) + grupo.astype(np.int64) * m]]
+
+
+# ---------- CMV PELO PEPS (FIFO) ----------
+# O custo das primeiras q unidades compradas de um produto é linear por partes
+# em q, então o custo de cada venda sai de duas interpolações sobre as somas
+# acumuladas das compras. Uma venda só consome lotes comprados até a data
+# dela: o consumido até a venda i é c_i = min(c_{i-1} + q_i, comprado até a
+# data de i), que se resolve com um mínimo acumulado. Unidades vendidas sem
+# estoque comprado até a data ficam sem custo (`sem_custo`) e não consomem
+# lotes futuros.
+def cmv_fifo(compra_prod, compra_qtd, compra_preco, compra_dia,
+             venda_prod, venda_qtd, venda_dia):
+    pv, n, ov, xp, fp, ini, ate = _preparar(
+        compra_prod, compra_qtd, compra_preco, compra_dia, venda_prod, venda_dia)
+
+    if len(pv) == 0:
+        return np.zeros(0), np.zeros(0)
+    p = pv[ov]
+    q = venda_qtd[ov]
+    inicio = xp[ini[ov]]
+    disponivel = xp[ate[ov]] - inicio
+    # vendas acumuladas dentro de cada produto
+    acum = np.cumsum(q)
+    vendido = np.bincount(p, weights=q, minlength=n)
+    acum -= (np.cumsum(vendido) - vendido)[p]
+
+    consumido = acum + np.minimum(0.0, _minimo_acumulado(disponivel - acum, p))
+    anterior = np.concatenate([[0.0], consumido[:-1]])
+    anterior[np.concatenate([[True], p[1:] != p[:-1]])] = 0.0
+    custo = np.interp(inicio + consumido, xp, fp) - np.interp(inicio + anterior, xp, fp)
+
+    cmv = np.empty_like(custo)
+    cmv[ov] = custo
+    sem_custo = np.empty_like(custo)
+    sem_custo[ov] = q - (consumido - anterior)
+    return cmv, sem_custo
+
+
+# ---------- CMV PELO CUSTO MÉDIO ----------
+# Custo médio ponderado de todas as compras do produto até a data da venda.
+# Se ainda não havia compra nessa data, a venda fica sem custo, como no PEPS.
+def cmv_media(compra_prod, compra_qtd, compra_preco, compra_dia,
+              venda_prod, venda_qtd, venda_dia):
+    pv, n, ov, xp, fp, ini, ate = _preparar(
+        compra_prod, compra_qtd, compra_preco, compra_dia, venda_prod, venda_dia)
+
+    qtd = xp[ate] - xp[ini]
+    custo = fp[ate] - fp[ini]
+    media = np.divide(custo, qtd, out=np.zeros(len(qtd)), where=qtd > 0)
+    cmv = venda_qtd * media
+    sem_custo = np.where(qtd > 0, 0.0, venda_qtd)
+    return cmv, sem_custo
+
+
+def calcular_cmv(mov, metodo):
+    f = cmv_fifo if metodo == 'fifo' else cmv_media
+    return f(mov['compra_prod'], mov['compra_qtd'], mov['compra_preco'], mov['compra_dia'],
+             mov['venda_prod'], mov['venda_qtd'], mov['venda_dia'])
+
+
+# ---------- MARGEM BRUTA ----------
+# valor_final do Pedido é a receita total do pedido (não o preço unitário).
+def _agrupar(chave, mov, cmv, sem_custo):
+    grupos, inv = np.unique(chave, return_inverse=True)
+    m = len(grupos)
+    quantidade = np.bincount(inv, weights=mov['venda_qtd'], minlength=m)
+    receita = np.bincount(inv, weights=mov['venda_valor'], minlength=m)
+    custo = np.bincount(inv, weights=cmv, minlength=m)
+    faltante = np.bincount(inv, weights=sem_custo, minlength=m)
+    margem = receita - custo
+    pct = np.divide(margem, receita, out=np.zeros(m), where=receita != 0)
+    return grupos, quantidade, receita, custo, margem, pct, faltante
+
+
+def margem_por_produto(mov, metodo, nomes):
+    cmv, sem_custo = calcular_cmv(mov, metodo)
+    linhas = []
+    for cod, qtd, rec, cus, mar, pct, falt in zip(*_agrupar(mov['venda_prod'], mov, cmv, sem_custo)):
+        linhas.append({
+            'cod': int(cod),
+            'produto': nomes.get(int(cod)),
+            'quantidade': float(qtd),
+            'receita': round(float(rec), 2),
+            'cmv': round(float(cus), 2),
+            'margem': round(float(mar), 2),
+            'margem_pct': round(float(pct) * 100, 2),
+            'quantidade_sem_custo': float(falt)
+        })
+    return linhas
+
+
+def margem_por_mes(mov, metodo):
+    cmv, sem_custo = calcular_cmv(mov, metodo)
+    linhas = []
+    for mes, qtd, rec, cus, mar, pct, falt in zip(*_agrupar(mov['venda_mes'], mov, cmv, sem_custo)):
+        linhas.append({
+            'mes': f'{int(mes) // 100:04d}-{int(mes) % 100:02d}',
+            'quantidade': float(qtd),
+            'receita': round(float(rec), 2),
+            'cmv': round(float(cus), 2),
+            'margem': round(float(mar), 2),
+            'margem_pct': round(float(pct) * 100, 2),
+            'quantidade_sem_custo': float(falt)
+        })
+    return linhas
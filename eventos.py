@@ -0,0 +1,205 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+# ----- Feed de alterações (pedidos, vendas, estoque) por usuário -----
+# Os eventos vão para um log em SQLite local, compartilhado pelos workers do
+# gunicorn. Cada worker tem uma única thread que lê o log e distribui os eventos
+# novos para as conexões SSE abertas nele. O id do evento SSE é
+# "<geração>-<id no log>": a geração é criada junto com o arquivo, então se o
+# log for recriado (deploy, nova instância, limpeza do /tmp) o Last-Event-ID
+# antigo não bate e o cliente recebe 'reset' em vez de ficar sem eventos.
+CAMINHO = os.getenv('EVENTOS_DB', os.path.join(tempfile.gettempdir(), 'erp_eventos.db'))
+RETENCAO = 60 * 60        # eventos guardados para retomada (s)
+INTERVALO = 0.25          # leitura do log pela thread do worker (s)
+HEARTBEAT = 15            # comentário SSE para manter a conexão viva (s)
+DURACAO_MAX = 5 * 60      # o cliente reconecta sozinho depois disso (s)
+MAX_FILA = 1000           # eventos pendentes por conexão antes de derrubá-la
+# Cada stream aberto ocupa uma thread do worker (gthread) por até DURACAO_MAX.
+# O limite fica abaixo das --threads do Procfile para sobrar thread para as
+# outras rotas; acima dele /eventos responde 503 e o cliente tenta de novo.
+MAX_CONEXOES = int(os.getenv('EVENTOS_MAX_CONEXOES', 16))
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+_assinantes = {}          # user_id -> set de filas
+_trava = threading.Lock()
+_leitor = None
+_conexoes = 0
+
+
+def _db():
+    db = getattr(_local, 'db', None)
+    if db is None:
+        db = sqlite3.connect(CAMINHO, timeout=5, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS eventos (
+                id        INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id   INTEGER NOT NULL,
+                tipo      TEXT NOT NULL,
+                dados     TEXT NOT NULL,
+                criado_em REAL NOT NULL
+            )
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS idx_eventos_user ON eventos (user_id, id)")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_eventos_criado ON eventos (criado_em)")
+        db.execute("CREATE TABLE IF NOT EXISTS meta (chave TEXT PRIMARY KEY, valor TEXT NOT NULL)")
+        db.execute("INSERT OR IGNORE INTO meta (chave, valor) VALUES ('geracao', ?)", (uuid.uuid4().hex[:12],))
+        _local.geracao = db.execute("SELECT valor FROM meta WHERE chave = 'geracao'").fetchone()[0]
+        _local.db = db
+    return db
+
+
+def _geracao():
+    _db()
+    return _local.geracao
+
+
+# Chamar depois do commit no MySQL. Falha no feed não derruba a requisição:
+# no pior caso a tela só atualiza no próximo carregamento.
+def publicar(user_id, tipo, dados):
+    try:
+        db = _db()
+        agora = time.time()
+        cur = db.execute("INSERT INTO eventos (user_id, tipo, dados, criado_em) VALUES (?, ?, ?, ?)",
+                         (user_id, tipo, json.dumps(dados, default=str), agora))
+        if cur.lastrowid % 500 == 0:
+            db.execute("DELETE FROM eventos WHERE criado_em < ?", (agora - RETENCAO,))
+    except sqlite3.Error as e:
+        log.warning('Falha ao publicar evento %s: %s', tipo, e)
+
+
+# Erros do SQLite (ex.: "database is locked" enquanto outro worker publica)
+# só pulam a rodada: a thread não pode morrer, senão o worker para de entregar
+# eventos até a próxima conexão.
+def _ler_log():
+    ultimo = None
+    while True:
+        time.sleep(INTERVALO)
+        try:
+            db = _db()
+            if ultimo is None:
+                ultimo = db.execute("SELECT COALESCE(MAX(id), 0) FROM eventos").fetchone()[0]
+            with _trava:
+                usuarios = list(_assinantes)
+            if not usuarios:
+                ultimo = db.execute("SELECT COALESCE(MAX(id), ?) FROM eventos", (ultimo,)).fetchone()[0]
+                continue
+            novos = db.execute("SELECT id, user_id, tipo, dados FROM eventos WHERE id > ? ORDER BY id",
+                               (ultimo,)).fetchall()
+        except sqlite3.Error as e:
+            log.warning('Falha ao ler o log de eventos: %s', e)
+            continue
+        for evento in novos:
+            ultimo = evento[0]
+            with _trava:
+                filas = list(_assinantes.get(evento[1], ()))
+            for fila in filas:
+                if fila.qsize() >= MAX_FILA:
+                    # cliente lento: encerra a conexão e ele retoma pelo Last-Event-ID
+                    _remover(evento[1], fila)
+                    fila.put(None)
+                else:
+                    fila.put(evento)
+
+
+def _remover(user_id, fila):
+    with _trava:
+        filas = _assinantes.get(user_id)
+        if filas is not None:
+            filas.discard(fila)
+            if not filas:
+                del _assinantes[user_id]
+
+
+def _iniciar_leitor():
+    global _leitor
+    with _trava:
+        if _leitor is None or not _leitor.is_alive():
+            _leitor = threading.Thread(target=_ler_log, daemon=True)
+            _leitor.start()
+
+
+# Reserva uma das MAX_CONEXOES vagas de stream deste worker. Quem reserva
+# chama liberar() quando a resposta fecha.
+def reservar():
+    global _conexoes
+    with _trava:
+        if _conexoes >= MAX_CONEXOES:
+            return False
+        _conexoes += 1
+        return True
+
+
+def liberar():
+    global _conexoes
+    with _trava:
+        _conexoes -= 1
+
+
+def _formatar(evento, geracao):
+    id_, _, tipo, dados = evento
+    return f"id: {geracao}-{id_}\nevent: {tipo}\ndata: {dados}\n\n"
+
+
+# Gerador do corpo text/event-stream para um usuário, a partir do Last-Event-ID
+# recebido (ultimo_id, no formato "<geração>-<id>").
+def assinar(user_id, ultimo_id=None):
+    _iniciar_leitor()
+
+    def gerar():
+        # registra a fila antes de ler o backlog para não perder nada no meio
+        fila = queue.Queue()
+        with _trava:
+            _assinantes.setdefault(user_id, set()).add(fila)
+        try:
+            yield "retry: 3000\n\n"
+            db = _db()
+            geracao = _geracao()
+            enviado = None
+            if ultimo_id:
+                geracao_cliente, _, numero = ultimo_id.rpartition('-')
+                menor, maior = db.execute("SELECT MIN(id), MAX(id) FROM eventos").fetchone()
+                if (geracao_cliente != geracao or not numero.isdigit()
+                        or int(numero) > (maior or 0)):
+                    # id de outro log (recriado): não dá para saber o que foi perdido
+                    yield "event: reset\ndata: {}\n\n"
+                else:
+                    enviado = int(numero)
+                    if menor is not None and enviado < menor - 1:
+                        # o que foi perdido já saiu do log: o cliente precisa recarregar
+                        yield "event: reset\ndata: {}\n\n"
+                    backlog = db.execute("""
+                        SELECT id, user_id, tipo, dados FROM eventos
+                        WHERE user_id = ? AND id > ? ORDER BY id
+                    """, (user_id, enviado)).fetchall()
+                    for evento in backlog:
+                        enviado = evento[0]
+                        yield _formatar(evento, geracao)
+
+            fim = time.monotonic() + DURACAO_MAX
+            while time.monotonic() < fim:
+                try:
+                    evento = fila.get(timeout=HEARTBEAT)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                if evento is None:
+                    return
+                if enviado is not None and evento[0] <= enviado:
+                    continue  # já foi no backlog
+                enviado = evento[0]
+                yield _formatar(evento, geracao)
+        finally:
+            _remover(user_id, fila)
+
+    return gerar()
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import logging
+import time
+from functools import wraps
+
+from flask import request, jsonify, make_response
+
+# Chaves ficam num SQLite local: é compartilhado entre os workers do gunicorn
+# da mesma máquina e a PRIMARY KEY garante que só uma requisição "ganha" a chave.
+CAMINHO = os.getenv('IDEMPOTENCIA_DB', os.path.join(tempfile.gettempdir(), 'erp_idempotencia.db'))
+VALIDADE = int(os.getenv('IDEMPOTENCIA_TTL', 24 * 60 * 60))  # segundos
+RESERVA = 120     # se o worker morrer no meio, a chave é liberada depois disso (s)
+ESPERA_MAX = 10   # quanto uma duplicata espera a original terminar (s)
+INTERVALO = 0.05
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def _db():
+    db = getattr(_local, 'db', None)
+    if db is None:
+        db = sqlite3.connect(CAMINHO, timeout=5, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS chaves (
+                escopo    TEXT PRIMARY KEY,
+                hash_corpo TEXT NOT NULL,
+                status    INTEGER,
+                corpo     BLOB,
+                headers   TEXT,
+                expira_em REAL NOT NULL
+            )
+        """)
+        db.execute("CREATE INDEX IF NOT EXISTS idx_chaves_expira ON chaves (expira_em)")
+        _local.db = db
+    return db
+
+
+def _limpar_expiradas(db):
+    db.execute("DELETE FROM chaves WHERE expira_em < ?", (time.time(),))
+
+
+def _reservar(db, escopo, hash_corpo):
+    try:
+        db.execute("INSERT INTO chaves (escopo, hash_corpo, expira_em) VALUES (?, ?, ?)",
+                   (escopo, hash_corpo, time.time() + RESERVA))
+        return True
+    except sqlite3.IntegrityError:
+        return False
+
+
+def _liberar(db, escopo):
+    try:
+        db.execute("DELETE FROM chaves WHERE escopo = ?", (escopo,))
+    except sqlite3.OperationalError as e:
+        log.warning('Não foi possível liberar a Idempotency-Key: %s', e)
+
+
+def _replay(row):
+    status, corpo, headers = row
+    resposta = make_response(corpo, status)
+    for nome, valor in json.loads(headers):
+        resposta.headers[nome] = valor
+    resposta.headers['Idempotent-Replayed'] = 'true'
+    return resposta
+
+
+# Reserva a chave para esta requisição (devolve None) ou devolve a resposta
+# para a duplicata: replay, 422 (corpo diferente) ou 409 (original demorando).
+def _aguardar_reserva(db, escopo, hash_corpo):
+    prazo = time.monotonic() + ESPERA_MAX
+    while not _reservar(db, escopo, hash_corpo):
+        row = db.execute("SELECT hash_corpo, status, corpo, headers, expira_em FROM chaves WHERE escopo = ?",
+                         (escopo,)).fetchone()
+        if row is None or row[4] < time.time():
+            # expirou (ou foi liberada) entre o INSERT e o SELECT: tenta de novo
+            db.execute("DELETE FROM chaves WHERE escopo = ? AND expira_em < ?", (escopo, time.time()))
+            continue
+        if row[0] != hash_corpo:
+            return jsonify({'erro': 'Idempotency-Key já usada com outro corpo'}), 422
+        if row[1] is not None:
+            return _replay(row[1:4])
+        if time.monotonic() > prazo:
+            return jsonify({'erro': 'Requisição com esta Idempotency-Key ainda em andamento'}), 409
+        time.sleep(INTERVALO)
+    return None
+
+
+# Decorador para rotas de escrita: com o header Idempotency-Key, a primeira
+# resposta de sucesso (2xx) é gravada e repetida para as duplicatas (inclusive
+# as que chegam enquanto a original ainda está em andamento). Usar depois de
+# @token_requerido.
+def idempotente(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        chave = request.headers.get('Idempotency-Key')
+        if not chave:
+            return f(*args, **kwargs)
+        if len(chave) > 255:
+            return jsonify({'erro': 'Idempotency-Key muito longa'}), 400
+
+        escopo = f"{request.usuario['id']}:{request.method}:{request.path}:{chave}"
+        hash_corpo = hashlib.sha256(request.get_data()).hexdigest()
+        try:
+            db = _db()
+            resultado = _aguardar_reserva(db, escopo, hash_corpo)
+        except sqlite3.OperationalError as e:
+            # store travado: nada foi gravado ainda, o cliente pode repetir
+            log.warning('Idempotency-Key indisponível: %s', e)
+            resposta = jsonify({'erro': 'Tente novamente em instantes'})
+            resposta.headers['Retry-After'] = '1'
+            return resposta, 503
+        if resultado is not None:
+            return resultado
+
+        try:
+            resposta = make_response(f(*args, **kwargs))
+        except Exception:
+            _liberar(db, escopo)
+            raise
+
+        # só sucesso é gravado: um 4xx como "Estoque insuficiente" pode deixar
+        # de valer, e o cliente precisa poder repetir a mesma chave depois
+        if not 200 <= resposta.status_code < 300:
+            _liberar(db, escopo)
+            return resposta
+        try:
+            headers = [(k, v) for k, v in resposta.headers.items() if k.lower() == 'content-type']
+            db.execute("UPDATE chaves SET status = ?, corpo = ?, headers = ?, expira_em = ? WHERE escopo = ?",
+                       (resposta.status_code, resposta.get_data(), json.dumps(headers),
+                        time.time() + VALIDADE, escopo))
+            _limpar_expiradas(db)
+        except sqlite3.OperationalError as e:
+            # a escrita no MySQL já foi feita: não vira 500. A reserva expira
+            # sozinha depois de RESERVA segundos.
+            log.warning('Não foi possível gravar a resposta da Idempotency-Key: %s', e)
+        return resposta
+    return decorated
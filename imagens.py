@@ -0,0 +1,244 @@
+import hashlib
+import ipaddress
+import logging
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from PIL import Image
+
+# ----- Cache local das imagens dos produtos -----
+# Cada imagem_url é baixada uma vez; o original fica em disco endereçado pelo
+# sha256 do conteúdo e uma miniatura de tamanho fixo é gerada em segundo plano.
+# As rotas devolvem '/imagens/<sha>.jpg' quando a miniatura já existe e None
+# enquanto ela não fica pronta (o frontend usa a imagem_url original).
+PASTA = os.getenv('IMAGENS_DIR', os.path.join(tempfile.gettempdir(), 'erp_imagens'))
+TAMANHO = 256                                   # lado máximo da miniatura (px)
+TAMANHO_CACHE = int(os.getenv('IMAGENS_CACHE_MB', 500)) * 1024 * 1024
+MAX_DOWNLOAD = 10 * 1024 * 1024
+TIMEOUT = 10
+TRABALHADORES = 2
+MAX_REDIRECIONAMENTOS = 3
+ESPERA_FALHA = 60 * 60                          # não tenta de novo uma URL que falhou (s)
+
+Image.MAX_IMAGE_PIXELS = 50_000_000
+NOME_VALIDO = re.compile(r'^[0-9a-f]{64}\.jpg$')
+
+log = logging.getLogger(__name__)
+
+_pool = ThreadPoolExecutor(TRABALHADORES, thread_name_prefix='imagens')
+_trava = threading.Lock()
+_em_andamento = set()
+_falhas = {}        # url -> quando falhou
+_indice = {}        # hash da url -> hash do conteúdo (cópia em memória de PASTA/urls)
+_ocupado = None     # bytes em disco (estimativa; recalculada na limpeza)
+
+
+def _caminho(*partes):
+    return os.path.join(PASTA, *partes)
+
+
+def _hash_url(url):
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+def _gravar(caminho, dados):
+    # grava num temporário e renomeia: quem lê nunca vê arquivo pela metade
+    os.makedirs(os.path.dirname(caminho), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(caminho))
+    with os.fdopen(fd, 'wb') as arq:
+        arq.write(dados)
+    os.replace(tmp, caminho)
+
+
+def miniatura(sha):
+    return _caminho('miniaturas', sha + '.jpg')
+
+
+# URL local da miniatura, ou None se ainda não existe (nesse caso agenda o download).
+def miniatura_url(imagem_url):
+    if not imagem_url or not isinstance(imagem_url, str):
+        return None
+    chave = _hash_url(imagem_url)
+    sha = _indice.get(chave)
+    if sha is None:
+        try:
+            with open(_caminho('urls', chave)) as arq:
+                sha = _indice[chave] = arq.read().strip()
+        except OSError:
+            pass
+    if sha and os.path.exists(miniatura(sha)):
+        return f'/imagens/{sha}.jpg'
+    agendar(imagem_url)
+    return None
+
+
+def agendar(imagem_url):
+    if not isinstance(imagem_url, str) or not imagem_url.lower().startswith(('http://', 'https://')):
+        return
+    with _trava:
+        if imagem_url in _em_andamento or time.time() - _falhas.get(imagem_url, 0) < ESPERA_FALHA:
+            return
+        _em_andamento.add(imagem_url)
+    _pool.submit(_processar, imagem_url)
+
+
+# A imagem_url vem do usuário: o servidor não pode ser usado para acessar a
+# rede interna (metadados da nuvem, banco, serviços em localhost). Todos os
+# endereços do host precisam ser públicos. Devolve o endereço verificado.
+def _verificar_destino(url):
+    partes = requests.utils.urlparse(url)
+    if partes.scheme not in ('http', 'https') or not partes.hostname:
+        raise ValueError('URL de imagem inválida')
+    try:
+        enderecos = socket.getaddrinfo(partes.hostname, partes.port or 80, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError) as e:
+        raise ValueError(f'host não resolvido: {e}')
+    for *_, sockaddr in enderecos:
+        ip = ipaddress.ip_address(sockaddr[0].split('%', 1)[0])
+        if getattr(ip, 'ipv4_mapped', None):
+            ip = ip.ipv4_mapped
+        if not ip.is_global or ip.is_multicast:
+            raise ValueError(f'endereço não permitido: {ip}')
+    return enderecos[0][4][0]
+
+
+# HTTPS para o IP já verificado: SNI e certificado continuam sendo do host
+# da URL original.
+class _AdaptadorHost(requests.adapters.HTTPAdapter):
+    def __init__(self, host):
+        self.host = host
+        super().__init__(max_retries=0)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['server_hostname'] = self.host
+        kwargs['assert_hostname'] = self.host
+        super().init_poolmanager(*args, **kwargs)
+
+
+# Redirecionamentos são seguidos à mão para cada destino passar pela mesma
+# verificação. A conexão vai para o IP verificado (com o Host original): se o
+# requests resolvesse o host de novo, um DNS com TTL 0 poderia responder outro
+# endereço (DNS rebinding).
+def _baixar(url):
+    for _ in range(MAX_REDIRECIONAMENTOS + 1):
+        ip = _verificar_destino(url)
+        alvo = requests.utils.urlparse(url)
+        host = alvo.netloc.rpartition('@')[2]
+        endereco = f'[{ip}]' if ':' in ip else ip
+        if alvo.port:
+            endereco += f':{alvo.port}'
+        with requests.Session() as sessao:
+            sessao.trust_env = False     # proxy do ambiente resolveria o host por conta própria
+            sessao.mount('https://', _AdaptadorHost(alvo.hostname))
+            with sessao.get(alvo._replace(netloc=endereco).geturl(), headers={'Host': host},
+                            stream=True, timeout=TIMEOUT, allow_redirects=False) as resposta:
+                if resposta.is_redirect:
+                    url = requests.compat.urljoin(url, resposta.headers['Location'])
+                    continue
+                resposta.raise_for_status()
+                partes, total = [], 0
+                for parte in resposta.iter_content(64 * 1024):
+                    total += len(parte)
+                    if total > MAX_DOWNLOAD:
+                        raise ValueError('imagem maior que o limite')
+                    partes.append(parte)
+        return b''.join(partes)
+    raise ValueError('redirecionamentos demais')
+
+
+def _gerar_miniatura(original, destino):
+    with Image.open(original) as img:
+        img.draft('RGB', (TAMANHO, TAMANHO))   # JPEG: decodifica já reduzido
+        img = img.convert('RGB')
+        img.thumbnail((TAMANHO, TAMANHO))
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(destino))
+        try:
+            with os.fdopen(fd, 'wb') as arq:
+                img.save(arq, 'JPEG', quality=85, optimize=True)
+        except Exception:
+            os.remove(tmp)
+            raise
+    os.replace(tmp, destino)
+
+
+def _processar(url):
+    try:
+        dados = _baixar(url)
+        sha = hashlib.sha256(dados).hexdigest()
+        original = _caminho('originais', sha)
+        escritos = 0
+        if not os.path.exists(original):
+            _gravar(original, dados)
+            escritos += len(dados)
+        destino = miniatura(sha)
+        if not os.path.exists(destino):
+            os.makedirs(os.path.dirname(destino), exist_ok=True)
+            _gerar_miniatura(original, destino)
+            escritos += os.path.getsize(destino)
+        chave = _hash_url(url)
+        _gravar(_caminho('urls', chave), sha.encode())
+        _indice[chave] = sha
+        _contabilizar(escritos)
+    except Exception as e:
+        log.warning('Falha ao gerar miniatura de %s: %s', url, e)
+        with _trava:
+            if len(_falhas) > 10000:
+                _falhas.clear()
+            _falhas[url] = time.time()
+    finally:
+        with _trava:
+            _em_andamento.discard(url)
+
+
+def _contabilizar(escritos):
+    global _ocupado
+    with _trava:
+        if _ocupado is not None:
+            _ocupado += escritos
+            if _ocupado <= TAMANHO_CACHE:
+                return
+    _limpar()
+
+
+# Remove os arquivos usados há mais tempo (mtime, renovado ao servir a
+# miniatura) até o cache voltar a 90% do limite. Os originais só servem para
+# gerar miniaturas e nunca são renovados, então saem primeiro.
+def _limpar():
+    global _ocupado
+    arquivos = []
+    for prioridade, sub in enumerate(('originais', 'miniaturas')):
+        try:
+            with os.scandir(_caminho(sub)) as it:
+                for e in it:
+                    st = e.stat()
+                    arquivos.append((prioridade, st.st_mtime, st.st_size, e.path))
+        except FileNotFoundError:
+            pass
+    total = sum(a[2] for a in arquivos)
+    if total > TAMANHO_CACHE:
+        for _, _, tam, caminho in sorted(arquivos):
+            if total <= TAMANHO_CACHE * 0.9:
+                break
+            try:
+                os.remove(caminho)
+                total -= tam
+            except OSError:
+                pass
+    with _trava:
+        _ocupado = total
+
+
+# Chamada pela rota ao servir: renova o mtime (no máximo uma vez por dia)
+# para a limpeza saber que a miniatura continua em uso.
+def tocar(caminho):
+    try:
+        if time.time() - os.path.getmtime(caminho) > 24 * 60 * 60:
+            os.utime(caminho)
+    except OSError:
+        pass
@@ -0,0 +1,31 @@
+-- Pedidos em aberto por usuário sem varrer o histórico inteiro.
+-- Rodar uma vez no banco antes de subir a versão que usa estas colunas.
+
+-- 1. Dono do pedido gravado no próprio Pedido (antes só via Produto.user_id)
+--    e indicador de aberto que pode ser usado por índice (status != 'finalizado' não pode).
+ALTER TABLE Pedido
+  ADD COLUMN user_id INT NULL,
+  ADD COLUMN aberto TINYINT(1) AS (COALESCE(status, '') <> 'finalizado') STORED;
+
+UPDATE Pedido p
+JOIN Produto pr ON pr.COD = p.id_produto
+SET p.user_id = pr.user_id;
+
+-- 2. Listagem de abertos: usuário + aberto + data (id desempata a paginação por chave)
+CREATE INDEX idx_pedido_abertos ON Pedido (user_id, aberto, data, id);
+
+-- 3. Contadores de pedidos em aberto por status e canal, mantidos pela API
+--    (criar_venda, atualizar_venda, remover_venda) na mesma transação do pedido.
+CREATE TABLE PedidoAbertoContagem (
+  user_id INT NOT NULL,
+  status  VARCHAR(50) NOT NULL,
+  canal   VARCHAR(50) NOT NULL,
+  total   INT NOT NULL DEFAULT 0,
+  PRIMARY KEY (user_id, status, canal)
+);
+
+INSERT INTO PedidoAbertoContagem (user_id, status, canal, total)
+SELECT user_id, COALESCE(status, ''), COALESCE(fk_marketplace_id, ''), COUNT(*)
+FROM Pedido
+WHERE user_id IS NOT NULL AND aberto = 1
+GROUP BY user_id, COALESCE(status, ''), COALESCE(fk_marketplace_id, '');
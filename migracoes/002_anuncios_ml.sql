@@ -0,0 +1,20 @@
+-- Vínculo entre produtos e anúncios do Mercado Livre, lido pela
+-- sincronização de estoque (sincml.py). Produto sem linha em AnuncioML não
+-- é sincronizado.
+
+CREATE TABLE AnuncioML (
+  fk_cod_prod INT NOT NULL,
+  item_id     VARCHAR(30) NOT NULL,
+  user_id     INT NOT NULL,
+  PRIMARY KEY (fk_cod_prod, item_id),
+  INDEX idx_anuncioml_user (user_id)
+);
+
+-- Tokens da conta do Mercado Livre de cada usuário: gravados pelo
+-- /auth/callback e renovados pela sincronização quando expira_em passa.
+CREATE TABLE TokenML (
+  user_id       INT NOT NULL PRIMARY KEY,
+  access_token  VARCHAR(255) NOT NULL,
+  refresh_token VARCHAR(255),
+  expira_em     DATETIME
+);
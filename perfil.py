@@ -0,0 +1,219 @@
+import collections
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import jwt
+import pymysql
+from flask import request, g
+
+from auth import SECRET_KEY
+
+# ----- Configurações do profiler -----
+# PERFIL_AMOSTRAGEM: fração das requisições perfiladas por rota, ex.
+#   "/pedidos=0.01,/relatorios/lucro-mensal=0.05"
+# Admins também podem pedir o perfil de uma requisição com o header "X-Perfil: 1".
+PASTA = os.getenv('PERFIL_DIR', os.path.join(tempfile.gettempdir(), 'erp_perfis'))
+INTERVALO = float(os.getenv('PERFIL_INTERVALO_MS', 5)) / 1000
+DURACAO_MAX = 30        # segundos amostrando, no máximo, por requisição
+MAX_SIMULTANEOS = 1     # perfis ao mesmo tempo por worker
+MAX_ARQUIVOS = 200      # perfis guardados na pasta (os mais antigos são apagados)
+MAX_SQL = 500           # consultas guardadas por perfil
+MAX_PROFUNDIDADE = 128
+CACHE_ADMIN = 60        # segundos que a checagem de admin do X-Perfil fica em cache
+
+# literais de string já interpolados pelo pymysql ('...' com escapes \)
+LITERAL = re.compile(r"'(?:[^'\\]|\\.)*'")
+
+_local = threading.local()
+_vagas = threading.BoundedSemaphore(MAX_SIMULTANEOS)
+_admins = {}            # user_id -> (é admin, válido até)
+
+
+def _ler_amostragem():
+    taxas = {}
+    for item in os.getenv('PERFIL_AMOSTRAGEM', '').split(','):
+        if '=' in item:
+            rota, taxa = item.rsplit('=', 1)
+            taxas[rota.strip()] = float(taxa)
+    return taxas
+
+AMOSTRAGEM = _ler_amostragem()
+
+
+# Conexão que mede cada consulta quando a requisição atual está sendo perfilada.
+# Fica no nível da conexão para pegar qualquer tipo de cursor.
+class ConexaoPerfilada(pymysql.connections.Connection):
+    def query(self, sql, unbuffered=False):
+        perfil = getattr(_local, 'perfil', None)
+        if perfil is None:
+            return super().query(sql, unbuffered)
+        inicio = time.perf_counter()
+        try:
+            return super().query(sql, unbuffered)
+        finally:
+            perfil.registrar_sql(sql, time.perf_counter() - inicio)
+
+
+class Perfil(threading.Thread):
+    def __init__(self, thread_id):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.pilhas = collections.Counter()
+        self.sql = []
+        self.sql_total = 0
+        self.sql_tempo = 0.0
+        self.status = None
+        self.inicio = time.perf_counter()
+        self._parar = threading.Event()
+
+    def registrar_sql(self, sql, duracao):
+        self.sql_total += 1
+        self.sql_tempo += duracao
+        if len(self.sql) < MAX_SQL:
+            if isinstance(sql, bytes):
+                sql = sql.decode('utf-8', 'replace')
+            # os valores já vêm no SQL: strings (e-mail, senha...) não vão para o disco
+            sql = LITERAL.sub("'?'", sql)
+            self.sql.append({'sql': ' '.join(sql.split())[:2000], 'ms': round(duracao * 1000, 3)})
+
+    def run(self):
+        limite = self.inicio + DURACAO_MAX
+        while not self._parar.wait(INTERVALO) and time.perf_counter() < limite:
+            frame = sys._current_frames().get(self.thread_id)
+            pilha = []
+            while frame is not None and len(pilha) < MAX_PROFUNDIDADE:
+                code = frame.f_code
+                pilha.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if pilha:
+                self.pilhas[';'.join(reversed(pilha))] += 1
+
+    def parar(self):
+        self._parar.set()
+        self.join()
+        self.duracao = time.perf_counter() - self.inicio
+
+
+def _e_admin(conectar):
+    bearer = request.headers.get('Authorization', '')
+    token = bearer.split(" ")[1] if " " in bearer else bearer
+    try:
+        uid = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])['id']
+    except (jwt.InvalidTokenError, KeyError):
+        return False
+
+    # cache por usuário: quem manda X-Perfil em toda requisição não abre
+    # uma conexão a mais em cada uma
+    agora = time.monotonic()
+    admin, validade = _admins.get(uid, (None, 0))
+    if validade > agora:
+        return admin
+    con = conectar()
+    with con:
+        with con.cursor() as cur:
+            cur.execute("SELECT tipo FROM Usuario WHERE id = %s", (uid,))
+            row = cur.fetchone()
+    admin = bool(row) and row['tipo'] == 'admin'
+    if len(_admins) > 10000:
+        _admins.clear()
+    _admins[uid] = (admin, agora + CACHE_ADMIN)
+    return admin
+
+
+def _deve_perfilar(conectar):
+    rota = request.url_rule.rule if request.url_rule else None
+    taxa = AMOSTRAGEM.get(rota)
+    if taxa and random.random() < taxa:
+        return 'amostragem'
+    if request.headers.get('X-Perfil') == '1' and _e_admin(conectar):
+        return 'admin'
+    return None
+
+
+def _gravar(perfil, origem):
+    os.makedirs(PASTA, exist_ok=True)
+    rota = (request.url_rule.rule if request.url_rule else request.path).strip('/').replace('/', '_') or 'raiz'
+    nome = f"{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}_{uuid.uuid4().hex[:8]}_{rota}"
+
+    with open(os.path.join(PASTA, nome + '.folded'), 'w') as arq:
+        for pilha, total in perfil.pilhas.most_common():
+            arq.write(f'{pilha} {total}\n')
+
+    proprio = collections.Counter()
+    for pilha, total in perfil.pilhas.items():
+        proprio[pilha.rsplit(';', 1)[-1]] += total
+    amostras = sum(perfil.pilhas.values())
+
+    resumo = {
+        'metodo': request.method,
+        'rota': request.url_rule.rule if request.url_rule else None,
+        'caminho': request.path,
+        'status': perfil.status,
+        'origem': origem,
+        'duracao_ms': round(perfil.duracao * 1000, 3),
+        'intervalo_ms': INTERVALO * 1000,
+        'amostras': amostras,
+        'funcoes_mais_lentas': [
+            {'funcao': f, 'amostras': n, 'pct': round(100 * n / amostras, 1)}
+            for f, n in proprio.most_common(15)
+        ],
+        'sql': {
+            'total': perfil.sql_total,
+            'tempo_ms': round(perfil.sql_tempo * 1000, 3),
+            'consultas': perfil.sql
+        }
+    }
+    with open(os.path.join(PASTA, nome + '.json'), 'w') as arq:
+        json.dump(resumo, arq, ensure_ascii=False, indent=2)
+
+    # mantém só os MAX_ARQUIVOS perfis mais recentes (2 arquivos por perfil)
+    arquivos = sorted(os.scandir(PASTA), key=lambda e: e.stat().st_mtime)
+    for entrada in arquivos[:max(0, len(arquivos) - 2 * MAX_ARQUIVOS)]:
+        try:
+            os.remove(entrada.path)
+        except OSError:
+            pass
+    return nome
+
+
+# Liga o profiler no app: a decisão é tomada antes da rota e o resultado é
+# gravado em PASTA (.folded para flamegraph.pl/speedscope e .json com o resumo).
+def registrar(app, conectar):
+    @app.before_request
+    def _iniciar_perfil():
+        origem = _deve_perfilar(conectar)
+        if not origem or not _vagas.acquire(blocking=False):
+            return
+        perfil = Perfil(threading.get_ident())
+        g.perfil, g.perfil_origem = perfil, origem
+        _local.perfil = perfil
+        perfil.start()
+
+    @app.after_request
+    def _status_perfil(resposta):
+        perfil = g.get('perfil')
+        if perfil is not None:
+            perfil.status = resposta.status_code
+        return resposta
+
+    @app.teardown_request
+    def _finalizar_perfil(erro=None):
+        perfil = g.pop('perfil', None)
+        if perfil is None:
+            return
+        _local.perfil = None
+        try:
+            perfil.parar()
+            nome = _gravar(perfil, g.pop('perfil_origem', None))
+            app.logger.info('Perfil gravado: %s', os.path.join(PASTA, nome))
+        except OSError as e:
+            app.logger.warning('Não foi possível gravar o perfil: %s', e)
+        finally:
+            _vagas.release()
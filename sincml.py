@@ -0,0 +1,262 @@
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+
+# ----- Sincronização de estoque com os anúncios do Mercado Livre -----
+# As rotas só avisam "o estoque do produto X mudou". As mudanças de um mesmo
+# produto são agrupadas numa janela e, na hora do envio, a quantidade é lida
+# do banco: vai sempre o valor mais recente, mesmo que outro worker tenha
+# alterado o estoque depois.
+ML_API_URL = os.getenv('ML_API_URL', 'https://api.mercadolibre.com')
+JANELA = float(os.getenv('ML_SYNC_JANELA', 2))   # espera sem novas mudanças (s)
+ESPERA_MAX = 10        # nenhuma mudança espera mais que isso (s)
+LOTE = 20              # produtos resolvidos por consulta ao banco
+CONCORRENCIA = 4       # chamadas simultâneas à API
+TENTATIVAS = 5
+BACKOFF = 1            # base do backoff exponencial (s)
+BACKOFF_MAX = 30
+TIMEOUT = 10
+MARGEM_TOKEN = 60      # renova o token do ML quando falta menos que isso (s)
+
+log = logging.getLogger(__name__)
+
+
+class ErroTemporario(Exception):
+    pass
+
+
+class SincronizadorEstoque:
+    def __init__(self, conectar, api_url=ML_API_URL, client_id=None, client_secret=None):
+        self.conectar = conectar
+        self.api_url = api_url.rstrip('/')
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self._pendentes = {}   # cod -> [primeira mudança, última mudança, tentativas, não antes de]
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pool = ThreadPoolExecutor(CONCORRENCIA, thread_name_prefix='sincml')
+        self._sessao = requests.Session()
+        adaptador = requests.adapters.HTTPAdapter(pool_maxsize=CONCORRENCIA)
+        self._sessao.mount('http://', adaptador)
+        self._sessao.mount('https://', adaptador)
+
+        self._em_envio = 0
+        self._enviados = 0
+        self._falhas = 0
+        self._descartados = 0
+        self._novas_tentativas = 0
+        self._renovacoes = 0
+        self._ultimo_atraso = None
+
+    # Avisa que o estoque do produto mudou (chamar depois do commit).
+    def registrar(self, cod):
+        agora = time.monotonic()
+        with self._cond:
+            pendente = self._pendentes.get(cod)
+            if pendente is None:
+                self._pendentes[cod] = [agora, agora, 0, 0]
+            else:
+                pendente[1] = agora
+            self._acordar()
+
+    def _acordar(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
+        self._cond.notify()
+
+    # Falha temporária (banco ou API): volta para a fila com backoff, mantendo
+    # a hora da primeira mudança para o atraso aparecer nas métricas. Depois
+    # de TENTATIVAS rodadas o produto é descartado até a próxima mudança.
+    def _reagendar(self, cod, primeira, tentativas):
+        with self._cond:
+            self._falhas += 1
+            if tentativas + 1 >= TENTATIVAS:
+                self._descartados += 1
+                log.warning('Estoque do produto %s não sincronizado após %d tentativas', cod, TENTATIVAS)
+                return
+            self._novas_tentativas += 1
+            espera = min(BACKOFF_MAX, BACKOFF * 2 ** tentativas) * random.uniform(0.5, 1)
+            pendente = self._pendentes.setdefault(cod, [primeira, primeira, 0, 0])
+            pendente[0] = min(pendente[0], primeira)
+            pendente[2] = max(pendente[2], tentativas + 1)
+            pendente[3] = time.monotonic() + espera
+            self._acordar()
+
+    def metricas(self):
+        agora = time.monotonic()
+        with self._cond:
+            mais_antiga = min((p[0] for p in self._pendentes.values()), default=None)
+            return {
+                'fila': len(self._pendentes),
+                'em_envio': self._em_envio,
+                'atraso_pendente_s': round(agora - mais_antiga, 3) if mais_antiga is not None else 0,
+                'ultimo_atraso_s': round(self._ultimo_atraso, 3) if self._ultimo_atraso is not None else None,
+                'enviados': self._enviados,
+                'falhas': self._falhas,
+                'descartados': self._descartados,
+                'novas_tentativas': self._novas_tentativas,
+                'tokens_renovados': self._renovacoes
+            }
+
+    def _prontos(self):
+        # devolve (produtos prontos, quanto esperar pelo próximo)
+        agora = time.monotonic()
+        prontos, espera = {}, None
+        for cod, (primeira, ultima, tentativas, nao_antes) in self._pendentes.items():
+            falta = max(min(ultima + JANELA, primeira + ESPERA_MAX), nao_antes) - agora
+            if falta <= 0:
+                prontos[cod] = (primeira, tentativas)
+            else:
+                espera = falta if espera is None else min(espera, falta)
+        for cod in prontos:
+            del self._pendentes[cod]
+        return prontos, espera
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                prontos, espera = self._prontos()
+                while not prontos:
+                    self._cond.wait(espera)
+                    prontos, espera = self._prontos()
+                self._em_envio = len(prontos)
+
+            cods = list(prontos)
+            for i in range(0, len(cods), LOTE):
+                lote = {cod: prontos[cod] for cod in cods[i:i + LOTE]}
+                try:
+                    self._enviar_lote(lote)
+                except Exception as e:
+                    log.warning('Falha ao sincronizar estoque com o ML: %s', e)
+                    for cod, (primeira, tentativas) in lote.items():
+                        self._reagendar(cod, primeira, tentativas)
+                with self._cond:
+                    self._em_envio -= len(lote)
+
+    # Produtos sem anúncio vinculado simplesmente não voltam na consulta.
+    def _anuncios(self, cods):
+        con = self.conectar()
+        with con:
+            with con.cursor() as cur:
+                marcadores = ', '.join(['%s'] * len(cods))
+                cur.execute(f"""
+                    SELECT a.fk_cod_prod AS cod, a.item_id, a.user_id, t.access_token,
+                           COALESCE(t.expira_em <= NOW() + INTERVAL %s SECOND, 0) AS expirado,
+                           COALESCE(e.quantidade, 0) AS quantidade
+                    FROM AnuncioML a
+                    JOIN TokenML t ON t.user_id = a.user_id
+                    LEFT JOIN Estoque e ON e.fk_cod_prod = a.fk_cod_prod
+                    WHERE a.fk_cod_prod IN ({marcadores})
+                """, (MARGEM_TOKEN, *cods))
+                return cur.fetchall()
+
+    def _enviar_lote(self, lote):
+        anuncios = self._anuncios(list(lote))
+        futuros = {self._pool.submit(self._enviar, a): a for a in anuncios}
+        wait(futuros)
+        agora = time.monotonic()
+        repetir = set()
+        for futuro, anuncio in futuros.items():
+            erro = futuro.exception()
+            primeira, tentativas = lote[anuncio['cod']]
+            if erro is None:
+                with self._cond:
+                    self._enviados += 1
+                    self._ultimo_atraso = agora - primeira
+            elif isinstance(erro, ErroTemporario):
+                # ainda pode dar certo: volta para a fila e reenvia o valor atual
+                repetir.add(anuncio['cod'])
+            else:
+                with self._cond:
+                    self._falhas += 1
+                    self._descartados += 1
+                log.warning('Anúncio %s não sincronizado: %s', anuncio['item_id'], erro)
+        for cod in repetir:
+            self._reagendar(cod, *lote[cod])
+
+    # O access token do ML dura poucas horas. Renova com o refresh_token e grava
+    # o novo par em TokenML. O FOR UPDATE segura a linha: se outro worker (ou
+    # outro anúncio do mesmo usuário) já renovou, usa o token dele em vez de
+    # gastar o refresh_token de novo (no ML ele só vale uma vez).
+    def _renovar(self, user_id, token_atual):
+        con = self.conectar()
+        with con:
+            with con.cursor() as cur:
+                cur.execute("""
+                    SELECT access_token, refresh_token,
+                           COALESCE(expira_em <= NOW() + INTERVAL %s SECOND, 0) AS expirado
+                    FROM TokenML WHERE user_id = %s FOR UPDATE
+                """, (MARGEM_TOKEN, user_id))
+                atual = cur.fetchone()
+                if atual is None:
+                    raise ValueError(f'usuário {user_id} sem conta do ML vinculada')
+                if atual['access_token'] != token_atual and not atual['expirado']:
+                    return atual['access_token']
+                if not atual['refresh_token'] or not self.client_id:
+                    raise ValueError(f'token do ML do usuário {user_id} expirado e sem como renovar')
+
+                resposta = self._sessao.post(f'{self.api_url}/oauth/token', json={
+                    'grant_type': 'refresh_token',
+                    'client_id': self.client_id,
+                    'client_secret': self.client_secret,
+                    'refresh_token': atual['refresh_token']
+                }, timeout=TIMEOUT)
+                if resposta.status_code == 429 or resposta.status_code >= 500:
+                    raise ErroTemporario(f'renovação do token: HTTP {resposta.status_code}')
+                if resposta.status_code != 200:
+                    # refresh_token recusado: o usuário precisa refazer o /auth/login
+                    raise ValueError(f'renovação do token recusada: HTTP {resposta.status_code}: '
+                                     f'{resposta.text[:200]}')
+                tokens = resposta.json()
+                cur.execute("""
+                    UPDATE TokenML
+                    SET access_token = %s, refresh_token = %s, expira_em = NOW() + INTERVAL %s SECOND
+                    WHERE user_id = %s
+                """, (tokens['access_token'], tokens.get('refresh_token', atual['refresh_token']),
+                      int(tokens.get('expires_in', 21600)), user_id))
+            con.commit()
+        with self._cond:
+            self._renovacoes += 1
+        return tokens['access_token']
+
+    def _enviar(self, anuncio):
+        url = f"{self.api_url}/items/{anuncio['item_id']}"
+        corpo = {'available_quantity': max(0, int(anuncio['quantidade']))}
+        token = anuncio['access_token']
+        if anuncio['expirado']:
+            token = self._renovar(anuncio['user_id'], token)
+        renovado = bool(anuncio['expirado'])
+
+        for tentativa in range(TENTATIVAS):
+            try:
+                resposta = self._sessao.put(url, json=corpo, timeout=TIMEOUT,
+                                            headers={'Authorization': f'Bearer {token}'})
+                if resposta.status_code == 401 and not renovado:
+                    # expirou antes do previsto: renova uma vez antes de desistir
+                    token, renovado = self._renovar(anuncio['user_id'], token), True
+                    resposta = self._sessao.put(url, json=corpo, timeout=TIMEOUT,
+                                                headers={'Authorization': f'Bearer {token}'})
+            except requests.RequestException as e:
+                motivo, espera = str(e), None
+            else:
+                if resposta.status_code < 300:
+                    return
+                if resposta.status_code != 429 and resposta.status_code < 500:
+                    raise ValueError(f'HTTP {resposta.status_code}: {resposta.text[:200]}')
+                motivo = f'HTTP {resposta.status_code}'
+                espera = resposta.headers.get('Retry-After')
+                espera = float(espera) if espera and espera.isdigit() else None
+
+            if tentativa == TENTATIVAS - 1:
+                raise ErroTemporario(motivo)
+            with self._cond:
+                self._novas_tentativas += 1
+            if espera is None:
+                espera = min(BACKOFF_MAX, BACKOFF * 2 ** tentativa) * random.uniform(0.5, 1)
+            time.sleep(espera)
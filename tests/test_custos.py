@@ -0,0 +1,84 @@
+from collections import deque
+
+import numpy as np
+import pytest
+
+import custos
+
+
+# Referências ingênuas, venda a venda, para conferir as versões vetorizadas.
+def fifo_referencia(compras, vendas):
+    lotes = {}
+    for prod, qtd, preco, dia in sorted(compras, key=lambda c: (c[0], c[3])):
+        lotes.setdefault(prod, deque()).append([qtd, preco, dia])
+
+    cmv = [0.0] * len(vendas)
+    faltante = [0.0] * len(vendas)
+    for i in sorted(range(len(vendas)), key=lambda i: (vendas[i][0], vendas[i][2])):
+        prod, qtd, dia = vendas[i]
+        fila = lotes.get(prod, deque())
+        while qtd > 1e-12 and fila and fila[0][2] <= dia:
+            usar = min(qtd, fila[0][0])
+            cmv[i] += usar * fila[0][1]
+            fila[0][0] -= usar
+            qtd -= usar
+            if fila[0][0] <= 1e-12:
+                fila.popleft()
+        faltante[i] = qtd
+    return cmv, faltante
+
+
+def media_referencia(compras, vendas):
+    cmv, faltante = [], []
+    for prod, qtd, dia in vendas:
+        anteriores = [c for c in compras if c[0] == prod and c[3] <= dia]
+        q = sum(c[1] for c in anteriores)
+        custo = sum(c[1] * c[2] for c in anteriores)
+        cmv.append(qtd * custo / q if q else 0.0)
+        faltante.append(0.0 if q else qtd)
+    return cmv, faltante
+
+
+def movimentos_aleatorios(rng):
+    nc, nv, npr = rng.integers(0, 60), rng.integers(0, 60), rng.integers(1, 6)
+    c = (rng.integers(0, npr, nc), rng.integers(1, 20, nc).astype(float),
+         rng.integers(1, 100, nc).astype(float), rng.integers(0, 30, nc))
+    v = (rng.integers(0, npr + 1, nv), rng.integers(1, 15, nv).astype(float),
+         rng.integers(0, 30, nv))
+    return c, v
+
+
+@pytest.mark.parametrize('semente', range(100))
+def test_fifo_confere_com_referencia(semente):
+    c, v = movimentos_aleatorios(np.random.default_rng(semente))
+    cmv, faltante = custos.cmv_fifo(*c, *v)
+    ref, ref_faltante = fifo_referencia(list(zip(*(a.tolist() for a in c))),
+                                        list(zip(*(a.tolist() for a in v))))
+    assert np.allclose(cmv, ref)
+    assert np.allclose(faltante, ref_faltante)
+
+
+@pytest.mark.parametrize('semente', range(100))
+def test_media_confere_com_referencia(semente):
+    c, v = movimentos_aleatorios(np.random.default_rng(semente))
+    cmv, faltante = custos.cmv_media(*c, *v)
+    ref, ref_faltante = media_referencia(list(zip(*(a.tolist() for a in c))),
+                                         list(zip(*(a.tolist() for a in v))))
+    assert np.allclose(cmv, ref)
+    assert np.allclose(faltante, ref_faltante)
+
+
+def test_fifo_nao_usa_lote_comprado_depois_da_venda():
+    compras = (np.array([1]), np.array([10.0]), np.array([5.0]), np.array([100]))
+    vendas = (np.array([1, 1]), np.array([4.0, 4.0]), np.array([50, 120]))
+    cmv, faltante = custos.cmv_fifo(*compras, *vendas)
+    assert cmv.tolist() == [0.0, 20.0]
+    assert faltante.tolist() == [4.0, 0.0]
+
+
+def test_sem_vendas():
+    compras = (np.array([1]), np.array([10.0]), np.array([5.0]), np.array([100]))
+    vazio = (np.array([], dtype=np.int64), np.array([]), np.array([], dtype=np.int64))
+    for f in (custos.cmv_fifo, custos.cmv_media):
+        cmv, faltante = f(*compras, *vazio)
+        assert len(cmv) == 0 and len(faltante) == 0
@@ -0,0 +1,116 @@
+import datetime
+import threading
+
+import jwt
+import pytest
+
+import app as modulo_app
+import eventos
+from auth import SECRET_KEY
+
+
+@pytest.fixture
+def cliente(tmp_path, monkeypatch):
+    monkeypatch.setattr(eventos, 'CAMINHO', str(tmp_path / 'eventos.db'))
+    monkeypatch.setattr(eventos, '_local', threading.local())
+    monkeypatch.setattr(eventos, 'MAX_CONEXOES', 1)
+    monkeypatch.setattr(eventos, '_conexoes', 0)
+    return modulo_app.app.test_client()
+
+
+def token(uid=1):
+    return jwt.encode({'id': uid, 'exp': datetime.datetime.utcnow() + datetime.timedelta(minutes=5)},
+                      SECRET_KEY, algorithm='HS256')
+
+
+def test_token_na_query_e_aceito(cliente):
+    resposta = cliente.get(f'/eventos?token={token()}', buffered=False)
+    assert resposta.status_code == 200
+    assert next(resposta.response) == b'retry: 3000\n\n'
+    resposta.close()
+    assert cliente.get('/eventos').status_code == 401
+
+
+def test_limite_de_streams_por_worker(cliente):
+    primeira = cliente.get(f'/eventos?token={token()}', buffered=False)
+    assert primeira.status_code == 200
+    assert cliente.get(f'/eventos?token={token()}').status_code == 503
+    primeira.close()
+    segunda = cliente.get(f'/eventos?token={token()}', buffered=False)
+    assert segunda.status_code == 200
+    segunda.close()
+
+
+def test_retoma_pelo_last_event_id(cliente, monkeypatch):
+    monkeypatch.setattr(eventos, 'DURACAO_MAX', 0)
+    for i in range(3):
+        eventos.publicar(1, 'pedido', {'i': i})
+    eventos.publicar(2, 'pedido', {'outro': True})
+    g = eventos._geracao()
+    corpo = cliente.get(f'/eventos?token={token()}', headers={'Last-Event-ID': f'{g}-1'}).get_data(as_text=True)
+    assert f'id: {g}-1\n' not in corpo
+    assert f'id: {g}-2\n' in corpo and f'id: {g}-3\n' in corpo
+    assert 'outro' not in corpo
+    assert 'reset' not in corpo
+
+
+def test_log_recriado_manda_reset(cliente, monkeypatch):
+    monkeypatch.setattr(eventos, 'DURACAO_MAX', 0)
+    g = eventos._geracao()
+    for i in range(3):
+        eventos.publicar(1, 'pedido', {'i': i})
+    # cliente que vinha de um log antigo, com ids maiores que os do log atual
+    for ultimo in ('antiga-500', f'{g}-500', '500'):
+        corpo = ''.join(eventos.assinar(1, ultimo))
+        assert 'event: reset\n' in corpo
+
+
+def test_depois_do_reset_recebe_eventos_novos(cliente):
+    g = eventos._geracao()
+    for i in range(3):
+        eventos.publicar(1, 'pedido', {'i': i})
+    stream = eventos.assinar(1, 'antiga-500')
+    assert next(stream) == 'retry: 3000\n\n'
+    assert next(stream) == 'event: reset\ndata: {}\n\n'
+    # entrega direta na fila, como faz a thread leitora do worker
+    fila, = eventos._assinantes[1]
+    fila.put((4, 1, 'pedido', '{"i": 3}'))
+    assert next(stream) == f'id: {g}-4\nevent: pedido\ndata: {{"i": 3}}\n\n'
+    stream.close()
+
+
+def test_geracao_sobrevive_a_novas_conexoes(cliente, tmp_path, monkeypatch):
+    g = eventos._geracao()
+    monkeypatch.setattr(eventos, '_local', threading.local())
+    assert eventos._geracao() == g
+    monkeypatch.setattr(eventos, '_local', threading.local())
+    monkeypatch.setattr(eventos, 'CAMINHO', str(tmp_path / 'outro.db'))
+    assert eventos._geracao() != g
+
+
+def test_leitor_sobrevive_a_banco_travado(cliente, monkeypatch):
+    monkeypatch.setattr(eventos, 'INTERVALO', 0.01)
+    db_real = eventos._db
+    falhas = []
+
+    def db_travado():
+        if threading.current_thread() is leitor and len(falhas) < 5:
+            falhas.append(1)
+            raise eventos.sqlite3.OperationalError('database is locked')
+        return db_real()
+
+    monkeypatch.setattr(eventos, '_db', db_travado)
+    leitor = threading.Thread(target=eventos._ler_log, daemon=True)
+    leitor.start()
+    fila = eventos.queue.Queue()
+    monkeypatch.setitem(eventos._assinantes, 7, {fila})
+
+    for _ in range(200):
+        if len(falhas) == 5:
+            break
+        threading.Event().wait(0.01)
+    assert len(falhas) == 5
+    threading.Event().wait(0.05)
+    eventos.publicar(7, 'estoque', {'cod': 1})
+    assert fila.get(timeout=2)[2] == 'estoque'
+    assert leitor.is_alive()
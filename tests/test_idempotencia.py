@@ -0,0 +1,76 @@
+import threading
+import time
+
+import pytest
+from flask import Flask, request, jsonify
+
+import idempotencia
+
+
+@pytest.fixture
+def cliente(tmp_path, monkeypatch):
+    monkeypatch.setattr(idempotencia, 'CAMINHO', str(tmp_path / 'chaves.db'))
+    monkeypatch.setattr(idempotencia, '_local', threading.local())
+
+    app = Flask(__name__)
+    app.chamadas = []
+    app.estoque = 0
+
+    @app.before_request
+    def usuario():
+        request.usuario = {'id': 1}
+
+    @app.route('/vendas', methods=['POST'])
+    @idempotencia.idempotente
+    def criar():
+        time.sleep(0.2)
+        app.chamadas.append(request.get_json())
+        if app.estoque < 1:
+            return jsonify({'mensagem': 'Estoque insuficiente'}), 400
+        return jsonify({'n': len(app.chamadas)}), 201
+
+    return app
+
+
+def test_duplicatas_concorrentes_recebem_a_primeira_resposta(cliente):
+    cliente.estoque = 1
+    respostas = []
+
+    def enviar():
+        respostas.append(cliente.test_client().post(
+            '/vendas', json={'a': 1}, headers={'Idempotency-Key': 'k'}))
+
+    threads = [threading.Thread(target=enviar) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(cliente.chamadas) == 1
+    assert all(r.status_code == 201 and r.get_json() == {'n': 1} for r in respostas)
+    assert sum(r.headers.get('Idempotent-Replayed') == 'true' for r in respostas) == 3
+
+
+def test_chave_com_outro_corpo_da_422(cliente):
+    cliente.estoque = 1
+    c = cliente.test_client()
+    assert c.post('/vendas', json={'a': 1}, headers={'Idempotency-Key': 'k'}).status_code == 201
+    assert c.post('/vendas', json={'a': 2}, headers={'Idempotency-Key': 'k'}).status_code == 422
+
+
+def test_erro_4xx_nao_e_repetido(cliente):
+    c = cliente.test_client()
+    assert c.post('/vendas', json={'a': 1}, headers={'Idempotency-Key': 'k'}).status_code == 400
+    cliente.estoque = 1
+    resposta = c.post('/vendas', json={'a': 1}, headers={'Idempotency-Key': 'k'})
+    assert resposta.status_code == 201
+    assert len(cliente.chamadas) == 2
+
+
+def test_store_travado_na_reserva_da_503(cliente, monkeypatch):
+    def travado(*args):
+        raise idempotencia.sqlite3.OperationalError('database is locked')
+    monkeypatch.setattr(idempotencia, '_reservar', travado)
+    resposta = cliente.test_client().post('/vendas', json={'a': 1}, headers={'Idempotency-Key': 'k'})
+    assert resposta.status_code == 503
+    assert cliente.chamadas == []
@@ -0,0 +1,109 @@
+import socket
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+import imagens
+
+
+@pytest.mark.parametrize('url', [
+    'http://127.0.0.1/a.jpg',
+    'http://localhost/a.jpg',
+    'http://10.0.0.5/a.jpg',
+    'http://192.168.1.1/a.jpg',
+    'http://169.254.169.254/latest/meta-data/',
+    'http://0.0.0.0/a.jpg',
+    'http://[::1]/a.jpg',
+    'http://[::ffff:127.0.0.1]/a.jpg',
+    'http://[fe80::1]/a.jpg',
+    'file:///etc/passwd',
+])
+def test_destino_interno_recusado(url):
+    with pytest.raises(ValueError):
+        imagens._verificar_destino(url)
+
+
+def test_destino_publico_aceito(monkeypatch):
+    monkeypatch.setattr(imagens.socket, 'getaddrinfo',
+                        lambda *a, **k: [(2, 1, 6, '', ('93.184.216.34', 80))])
+    imagens._verificar_destino('https://exemplo.com/a.jpg')
+
+
+def test_redirecionamento_para_rede_interna_recusado(monkeypatch):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(302)
+            self.send_header('Location', 'http://169.254.169.254/latest/meta-data/')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    servidor = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    inicial = f'http://127.0.0.1:{servidor.server_port}/a.jpg'
+    verificar = imagens._verificar_destino
+    # só o servidor do teste é liberado; o destino do redirect passa pela regra normal
+    monkeypatch.setattr(imagens, '_verificar_destino',
+                        lambda url: '127.0.0.1' if url == inicial else verificar(url))
+    try:
+        with pytest.raises(ValueError, match='não permitido'):
+            imagens._baixar(inicial)
+    finally:
+        servidor.shutdown()
+
+
+def _servidor(corpo):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            servidor.hosts.append(self.headers['Host'])
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(corpo)))
+            self.end_headers()
+            self.wfile.write(corpo)
+
+        def log_message(self, *args):
+            pass
+
+    servidor = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    servidor.hosts = []
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
+
+
+def test_dns_rebinding_nao_troca_o_destino(monkeypatch):
+    # DNS malicioso com TTL 0: o host responde um IP público na verificação e
+    # um interno na segunda consulta. Os dois IPs são simulados por servidores
+    # locais.
+    publico, interno = _servidor(b'imagem'), _servidor(b'segredo')
+    porta = publico.server_port
+    consultas = []
+    getaddrinfo_real = socket.getaddrinfo
+
+    def getaddrinfo(host, port, *args, **kwargs):
+        if host == 'imagens.teste':
+            consultas.append(host)
+            ip = '93.184.216.34' if len(consultas) == 1 else '169.254.169.254'
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', (ip, port))]
+        if host == '93.184.216.34':
+            return getaddrinfo_real('127.0.0.1', publico.server_port, *args, **kwargs)
+        if host == '169.254.169.254':
+            return getaddrinfo_real('127.0.0.1', interno.server_port, *args, **kwargs)
+        return getaddrinfo_real(host, port, *args, **kwargs)
+
+    monkeypatch.setattr(socket, 'getaddrinfo', getaddrinfo)
+    try:
+        assert imagens._baixar(f'http://imagens.teste:{porta}/a.jpg') == b'imagem'
+        assert consultas == ['imagens.teste']
+        assert publico.hosts == [f'imagens.teste:{porta}']
+        assert interno.hosts == []
+    finally:
+        publico.shutdown()
+        interno.shutdown()
+
+
+@pytest.mark.parametrize('valor', [None, '', 123, ['http://x'], {'url': 'http://x'}])
+def test_imagem_url_invalida_ignorada(valor):
+    imagens.agendar(valor)
+    assert imagens.miniatura_url(valor) is None
@@ -0,0 +1,45 @@
+import jwt
+from flask import Flask
+
+import perfil
+from auth import SECRET_KEY
+
+
+def test_sql_gravado_sem_literais_de_string():
+    p = perfil.Perfil(0)
+    p.registrar_sql("SELECT * FROM Usuario WHERE email = 'a@b.com' AND senha = 'it\\'s' AND id = 3", 0.001)
+    assert p.sql[0]['sql'] == "SELECT * FROM Usuario WHERE email = '?' AND senha = '?' AND id = 3"
+
+
+class ConexaoFalsa:
+    abertas = 0
+
+    def __init__(self, tipo):
+        ConexaoFalsa.abertas += 1
+        self.tipo = tipo
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params):
+        pass
+
+    def fetchone(self):
+        return {'tipo': self.tipo}
+
+
+def test_checagem_de_admin_fica_em_cache(monkeypatch):
+    monkeypatch.setattr(perfil, '_admins', {})
+    ConexaoFalsa.abertas = 0
+    token = jwt.encode({'id': 42}, SECRET_KEY, algorithm='HS256')
+    app = Flask(__name__)
+    for _ in range(5):
+        with app.test_request_context(headers={'Authorization': f'Bearer {token}', 'X-Perfil': '1'}):
+            assert perfil._e_admin(lambda: ConexaoFalsa('funcionario')) is False
+    assert ConexaoFalsa.abertas == 1
@@ -0,0 +1,229 @@
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+import sincml
+
+
+# Servidor local que imita PUT /items/<id> da API do Mercado Livre.
+class FakeML:
+    def __init__(self):
+        self.recebidos = {}          # item_id -> últimas quantidades recebidas
+        self.respostas = {}          # item_id -> lista de (status, headers) a devolver antes do 200
+        self.atraso = 0
+        self.em_andamento = 0
+        self.max_em_andamento = 0
+        self.trava = threading.Lock()
+        self.tokens_validos = None   # None: não confere o Authorization
+        self.renovacao = (200, {'access_token': 'novo', 'refresh_token': 'refresh-2', 'expires_in': 21600})
+        self.renovacoes = []
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                corpo = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                with fake.trava:
+                    fake.renovacoes.append(corpo)
+                status, resposta = fake.renovacao
+                dados = json.dumps(resposta).encode()
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(dados)))
+                self.end_headers()
+                self.wfile.write(dados)
+
+            def do_PUT(self):
+                item = self.path.rsplit('/', 1)[-1]
+                corpo = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                token = self.headers['Authorization'].split(' ', 1)[1]
+                if fake.tokens_validos is not None and token not in fake.tokens_validos:
+                    self.send_response(401)
+                    self.end_headers()
+                    return
+                with fake.trava:
+                    fake.em_andamento += 1
+                    fake.max_em_andamento = max(fake.max_em_andamento, fake.em_andamento)
+                    roteiro = fake.respostas.get(item)
+                    status, headers = roteiro.pop(0) if roteiro else (200, {})
+                    if status == 200:
+                        fake.recebidos.setdefault(item, []).append(corpo['available_quantity'])
+                time.sleep(fake.atraso)
+                with fake.trava:
+                    fake.em_andamento -= 1
+                self.send_response(status)
+                for nome, valor in headers.items():
+                    self.send_header(nome, valor)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.servidor = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.servidor.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.servidor.server_port}'
+
+
+# Banco falso: responde à consulta de anúncios com o estoque atual e guarda
+# o TokenML do usuário 1.
+class Banco:
+    def __init__(self):
+        self.estoque = {}
+        self.vinculados = set()
+        self.consultas = 0
+        self.falhar = False
+        self.token = {'access_token': 't', 'refresh_token': 'refresh-1', 'expirado': 0}
+
+    def conectar(self):
+        self.consultas += 1
+        if self.falhar:
+            raise ConnectionError('banco fora')
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params):
+        self.sql, self.params = sql, params
+        if 'UPDATE TokenML' in sql:
+            self.token = {'access_token': params[0], 'refresh_token': params[1], 'expirado': 0}
+
+    def fetchone(self):
+        return dict(self.token)
+
+    def fetchall(self):
+        return [{'cod': c, 'item_id': f'MLB{c}', 'user_id': 1, 'access_token': self.token['access_token'],
+                 'expirado': self.token['expirado'], 'quantidade': self.estoque[c]}
+                for c in self.params[1:] if c in self.vinculados]
+
+    def commit(self):
+        pass
+
+
+def esperar(condicao, limite=5):
+    fim = time.monotonic() + limite
+    while time.monotonic() < fim:
+        if condicao():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+@pytest.fixture
+def ambiente(monkeypatch):
+    monkeypatch.setattr(sincml, 'JANELA', 0.1)
+    monkeypatch.setattr(sincml, 'ESPERA_MAX', 1)
+    monkeypatch.setattr(sincml, 'BACKOFF', 0.01)
+    fake, banco = FakeML(), Banco()
+    yield fake, banco
+    fake.servidor.shutdown()
+
+
+def test_mudancas_sao_agrupadas_no_valor_mais_recente(ambiente):
+    fake, banco = ambiente
+    banco.vinculados = {1, 2}
+    sinc = sincml.SincronizadorEstoque(banco.conectar, fake.url)
+    for i in range(30):
+        banco.estoque[1] = 100 - i
+        banco.estoque[2] = 7
+        sinc.registrar(1)
+        sinc.registrar(2)
+        sinc.registrar(3)   # sem anúncio: ignorado sem erro
+
+    assert esperar(lambda: sinc.metricas()['enviados'] == 2)
+    assert fake.recebidos == {'MLB1': [71], 'MLB2': [7]}
+    assert sinc.metricas()['falhas'] == 0
+    assert banco.consultas == 1
+
+
+def test_concorrencia_limitada(ambiente):
+    fake, banco = ambiente
+    fake.atraso = 0.05
+    banco.vinculados = set(range(30))
+    banco.estoque = {c: c for c in range(30)}
+    sinc = sincml.SincronizadorEstoque(banco.conectar, fake.url)
+    for c in range(30):
+        sinc.registrar(c)
+
+    assert esperar(lambda: sinc.metricas()['enviados'] == 30)
+    assert 1 < fake.max_em_andamento <= sincml.CONCORRENCIA
+
+
+def test_429_com_retry_after_e_5xx_sao_repetidos(ambiente):
+    fake, banco = ambiente
+    banco.vinculados = {1}
+    banco.estoque = {1: 5}
+    fake.respostas['MLB1'] = [(429, {'Retry-After': '0'}), (503, {}), (500, {})]
+    sinc = sincml.SincronizadorEstoque(banco.conectar, fake.url)
+    sinc.registrar(1)
+
+    assert esperar(lambda: sinc.metricas()['enviados'] == 1)
+    assert fake.recebidos == {'MLB1': [5]}
+    assert sinc.metricas()['novas_tentativas'] == 3
+
+
+def test_falha_no_banco_tem_backoff_e_limite(ambiente):
+    fake, banco = ambiente
+    banco.falhar = True
+    sinc = sincml.SincronizadorEstoque(banco.conectar, fake.url)
+    sinc.registrar(1)
+
+    assert esperar(lambda: sinc.metricas()['descartados'] == 1)
+    time.sleep(0.3)
+    metricas = sinc.metricas()
+    assert banco.consultas == sincml.TENTATIVAS
+    assert metricas['falhas'] == sincml.TENTATIVAS
+    assert metricas['fila'] == 0
+
+
+def test_401_renova_o_token_e_reenvia(ambiente):
+    fake, banco = ambiente
+    banco.vinculados = {1}
+    banco.estoque = {1: 3}
+    fake.tokens_validos = {'novo'}
+    sinc = sincml.SincronizadorEstoque(banco.conectar, fake.url, client_id='app', client_secret='s')
+    sinc.registrar(1)
+
+    assert esperar(lambda: sinc.metricas()['enviados'] == 1)
+    assert fake.recebidos == {'MLB1': [3]}
+    assert fake.renovacoes == [{'grant_type': 'refresh_token', 'client_id': 'app',
+                                'client_secret': 's', 'refresh_token': 'refresh-1'}]
+    assert banco.token['access_token'] == 'novo' and banco.token['refresh_token'] == 'refresh-2'
+    assert sinc.metricas()['tokens_renovados'] == 1
+    assert sinc.metricas()['descartados'] == 0
+
+
+def test_token_expirado_e_renovado_antes_do_envio(ambiente):
+    fake, banco = ambiente
+    banco.vinculados = {1}
+    banco.estoque = {1: 3}
+    banco.token['expirado'] = 1
+    fake.tokens_validos = {'novo'}
+    sinc = sincml.SincronizadorEstoque(banco.conectar, fake.url, client_id='app', client_secret='s')
+    sinc.registrar(1)
+
+    assert esperar(lambda: sinc.metricas()['enviados'] == 1)
+    assert len(fake.renovacoes) == 1
+    assert sinc.metricas()['tokens_renovados'] == 1
+
+
+def test_refresh_recusado_descarta(ambiente):
+    fake, banco = ambiente
+    banco.vinculados = {1}
+    banco.estoque = {1: 3}
+    fake.tokens_validos = {'novo'}
+    fake.renovacao = (400, {'error': 'invalid_grant'})
+    sinc = sincml.SincronizadorEstoque(banco.conectar, fake.url, client_id='app', client_secret='s')
+    sinc.registrar(1)
+
+    assert esperar(lambda: sinc.metricas()['descartados'] == 1)
+    assert fake.recebidos == {}
+    assert sinc.metricas()['enviados'] == 0